@@ -21,8 +21,38 @@ if not PY2:
     string_types = (str,)
 
     from io import StringIO
+    from urllib.parse import urljoin
 
 else:
     string_types = (str, unicode)
 
     from cStringIO import StringIO
+    from urlparse import urljoin
+
+try:
+    from functools import lru_cache
+except ImportError:
+    from functools import wraps
+
+    def lru_cache(maxsize=128):
+        """
+        Stand-in for ``functools.lru_cache`` on pythons that don't have it. Rather than
+        tracking usage, the cache is simply emptied once it reaches ``maxsize``.
+        """
+        def decorating_function(fn):
+            cache = {}
+
+            @wraps(fn)
+            def wrapper(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    pass
+                if len(cache) >= maxsize:
+                    cache.clear()
+                rv = cache[args] = fn(*args)
+                return rv
+
+            wrapper.cache_clear = cache.clear
+            return wrapper
+        return decorating_function
@@ -1,19 +1,24 @@
 from collections import namedtuple
 import re
 
+from lxml import etree
+
 from ._compat import string_types
 from .exceptions import UnexpectedTokenError, TakeSyntaxError
 from .scanner import TokenType
-from .utils import split_name, get_via_name_list, save_to_name_list
+from .utils import split_name, get_via_name_list, save_to_name_list, elements_text
 
 
 _WS = re.compile(r'\s+')
 
 
-class _SaveNode(namedtuple('_SaveNode', 'ident_parts')):
+class _SaveNode(namedtuple('_SaveNode', 'parent_parts name')):
     __slots__ = ()
     def do(self, context):
-        save_to_name_list(context.rv, self.ident_parts, context.value)
+        dest = context.rv
+        for part in self.parent_parts:
+            dest = dest.setdefault(part, {})
+        dest[self.name] = context.value
 
 
 def make_save(parser):
@@ -25,18 +30,22 @@ def make_save(parser):
     # expecting only have one parameter
     if tok.type_ != TokenType.DirectiveStatementEnd:
         raise UnexpectedTokenError(tok.type_, TokenType.DirectiveStatementEnd, token=tok)
-    return None, _SaveNode(save_id_parts)
+    # split the path to the saved value at parse time, ex: "a.b.c" saves to
+    # rv["a"]["b"]["c"] with the parents ("a", "b") and the name "c"
+    return None, _SaveNode(save_id_parts[:-1], save_id_parts[-1])
 
 
 class _SaveEachNode(namedtuple('_SaveEachNode', 'ident_parts sub_ctx_node')):
     __slots__ = ()
     def do(self, context):
-        results = []
+        items = context.value
+        # the number of results is known up front, so don't grow the list item by item
+        results = [None] * len(items)
         save_to_name_list(context.rv, self.ident_parts, results)
-        for item in context.value:
-            rv = {}
-            results.append(rv)
-            self.sub_ctx_node.do(None, rv, item, item)
+        sub_ctx_do = self.sub_ctx_node.do
+        for i, item in enumerate(items):
+            rv = results[i] = {}
+            sub_ctx_do(None, rv, item, item, context.xhtml)
 
 
 def make_save_each(parser):
@@ -70,7 +79,7 @@ class _NamespaceNode(namedtuple('_NamespaceNode', 'ident_parts sub_ctx_node')):
         if not sub_rv:
             sub_rv = {}
             save_to_name_list(context.rv, self.ident_parts, sub_rv)
-        self.sub_ctx_node.do(None, sub_rv, context.value, context.value)
+        self.sub_ctx_node.do(None, sub_rv, context.value, context.value, context.xhtml)
 
 
 def make_namespace(parser):
@@ -100,7 +109,7 @@ class _DefSubroutine(namedtuple('_DefSubroutine', 'sub_ctx_node')):
     __slots__ = ()
     def do(self, context):
         rv = {}
-        self.sub_ctx_node.do(None, rv, context.value, context.value)
+        self.sub_ctx_node.do(None, rv, context.value, context.value, context.xhtml)
         context.last_value = rv
 
 
@@ -173,10 +182,12 @@ class _ShrinkNode(object):
     __slots__ = ()
     def do(self, context):
         val = context.value
-        if not isinstance(val, string_types):
-            tx = val.text()
-        else:
+        if isinstance(val, string_types):
             tx = val
+        elif isinstance(val, etree._Element):
+            tx = elements_text((val,))
+        else:
+            tx = elements_text(val)
         context.last_value = _WS.sub(' ', tx.strip())
 
 
@@ -206,7 +217,7 @@ class _CustomAccessor(namedtuple('_CustomAccessor', 'sub_ctx_node')):
     __slots__ = ()
     def do(self, context):
         rv = {}
-        self.sub_ctx_node.do(None, rv, context.value, context.value)
+        self.sub_ctx_node.do(None, rv, context.value, context.value, context.xhtml)
         context.last_value = rv.get('__last_value__', context.last_value)
 
 
@@ -246,7 +257,7 @@ class _RxMatchNode(namedtuple('_RxMatchNode', 'sub_ctx_node')):
         # only execute the sub-context if there was a match
         if m:
             value = (m.group(0),) + m.groups()
-            self.sub_ctx_node.do(None, context.rv, value, value)
+            self.sub_ctx_node.do(None, context.rv, value, value, context.xhtml)
 
 
 def make_rx_match(parser):
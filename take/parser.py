@@ -3,120 +3,382 @@ from itertools import chain
 import re
 import sys
 
+from cssselect import SelectorError
+from lxml import etree
 from pyquery import PyQuery
+from pyquery.cssselectpatch import JQueryTranslator
 
 from ._compat import string_types, StringIO
 from .directives import BUILTIN_DIRECTIVES
 from .exceptions import AlreadyParsedError, UnexpectedEOFError, \
      UnexpectedTokenError, InvalidDirectiveError, TakeSyntaxError
 from .scanner import Scanner, TokenType
-from .utils import split_name, get_via_name_list
+from .utils import split_name, get_via_name_list, elements_text, elements_own_text
 
 
 _BUILTIN_DIRECTIVES_IDS = set(BUILTIN_DIRECTIVES.keys())
 
+# the same translators PyQuery uses, so the jQuery pseudo classes (:first, :eq(),
+# etc) keep working, the xhtml one is case sensitive and used for xml documents
+_CSS_TRANSLATOR = JQueryTranslator(xhtml=False)
+_XHTML_CSS_TRANSLATOR = JQueryTranslator(xhtml=True)
 
-def ensure_pq(elm):
+
+def _translator(xhtml):
+    return _XHTML_CSS_TRANSLATOR if xhtml else _CSS_TRANSLATOR
+
+
+def ensure_pq(elm, xhtml=False):
     if isinstance(elm, PyQuery):
         return elm
     else:
-        return PyQuery(elm)
+        # sharing the translator skips PyQuery creating a new one for every wrapper
+        return PyQuery(elm, css_translator=_translator(xhtml))
+
+
+def compile_css_selector(selector, xhtml=False):
+    """
+    Translate a CSS selector to a compiled XPath expression, the same way PyQuery
+    does on every ``pq(selector)`` call, but only once.
+    """
+    xpath = _translator(xhtml).css_to_xpath(selector.replace('[@', '['),
+                                            'descendant-or-self::')
+    return etree.XPath(xpath)
 
 
+# queries are called with the value and whether the document being processed is
+# xml (xhtml), PyQuery values carry their own translator, but bare lxml elements,
+# like those iterated by "save each", need the flag to be queried the same way
+
 def make_css_query(selector):
-    return lambda elm: ensure_pq(elm)(selector)
+    select = _select_css(selector)
+    def css_query(elm, xhtml=False):
+        # elements are queried directly instead of being wrapped in a PyQuery first
+        if isinstance(elm, etree._Element):
+            return PyQuery(select((elm,), xhtml), css_translator=_translator(xhtml))
+        pq = ensure_pq(elm, xhtml)
+        return PyQuery(select(pq, pq._translator.xhtml), parent=pq)
+    css_query.selector = selector
+    css_query.selects = select
+    return css_query
+
+
+def _select_css(selector):
+    # indexed by the xhtml flag, the xhtml variant is only needed by xml documents
+    # so it's compiled the first time one is queried
+    xpaths = [compile_css_selector(selector), None]
+    def select(elements, xhtml):
+        xpath = xpaths[xhtml]
+        if xpath is None:
+            xpath = xpaths[xhtml] = compile_css_selector(selector, xhtml=True)
+        results = []
+        for tag in elements:
+            results.extend(xpath(tag))
+        return results
+    return select
 
 
 def make_regexp_query(rx):
-    def regexp_query(value):
+    def regexp_query(value, xhtml=False):
         if isinstance(value, string_types):
             return (rx, value)
         else:
-            return (rx, ensure_pq(value).text())
+            return (rx, text_query(value))
     return regexp_query
 
 
 def make_index_query(index_str):
     index = int(index_str)
-    if index > -1:
-        def index_query(value):
-            if hasattr(value, 'eq'):
-                return value.eq(index)
-            elif isinstance(value, Sequence) and len(value) > index:
-                return value[index]
-            else:
-                return ensure_pq(elm).eq(index)
-    else:
-        # PyQuery doesn't handle negative indexes, so calc the real index each time
-        def index_query(value):
-            if hasattr(value, 'eq'):
-                i = len(value) + index
-                return value.eq(i)
-            elif isinstance(value, Sequence) and len(value) + index > -1:
-                return value[index]
-            else:
-                elm = ensure_pq(elm)
-                i = len(elm) + index
-                elm.eq(i)
+    select = _select_index(index)
+    def index_query(value, xhtml=False):
+        if isinstance(value, PyQuery):
+            return PyQuery(select(value, xhtml), parent=value)
+        elif isinstance(value, etree._Element):
+            return PyQuery(select((value,), xhtml), css_translator=_translator(xhtml))
+        elif isinstance(value, Sequence):
+            # ex: the groups from "rx match"
+            n = len(value)
+            return value[index] if -n <= index < n else None
+        else:
+            pq = ensure_pq(value, xhtml)
+            return PyQuery(select(pq, xhtml), parent=pq)
+    index_query.selects = select
     return index_query
 
 
-def text_query(elm):
-    return ensure_pq(elm).text()
+def _select_index(index):
+    # check the bounds up front rather than relying on slicing, which selects the
+    # wrong element for negative indexes further back than the start
+    def select(elements, xhtml):
+        # xhtml is unused, it's accepted to match the CSS selects
+        n = len(elements)
+        return [elements[index]] if -n <= index < n else []
+    return select
+
 
+# lxml elements and PyQuery objects are read directly, anything else is
+# wrapped in a PyQuery first
 
-def own_text_query(elm):
-    return ''.join(item
-                   for item in ensure_pq(elm).contents()
-                   if isinstance(item, string_types))
+def text_query(elm, xhtml=False):
+    if isinstance(elm, etree._Element):
+        return elements_text((elm,))
+    return elements_text(ensure_pq(elm))
+
+
+def own_text_query(elm, xhtml=False):
+    if isinstance(elm, etree._Element):
+        return elements_own_text((elm,))
+    return elements_own_text(ensure_pq(elm))
+
+
+text_query.reads = elements_text
+own_text_query.reads = elements_own_text
+
+
+# attribute names PyQuery.attr() translates
+_ATTR_ALIASES = {'class_': 'class', 'for_': 'for'}
 
 
 def make_attr_query(attr):
-    return lambda elm: ensure_pq(elm).attr(attr)
+    attr = _ATTR_ALIASES.get(attr, attr)
+    def attr_query(elm, xhtml=False):
+        if isinstance(elm, etree._Element):
+            return elm.get(attr)
+        return read(ensure_pq(elm))
+    def read(elements):
+        return elements[0].get(attr) if elements else None
+    attr_query.reads = read
+    return attr_query
 
 
 def make_field_query(name):
     name_list = split_name(name)
-    return lambda source: get_via_name_list(source, name_list)
+    return lambda source, xhtml=False: get_via_name_list(source, name_list)
+
+
+def _chain_queries(queries):
+    def chained_query(value, xhtml=False):
+        for query in queries:
+            value = query(value, xhtml)
+        return value
+    return chained_query
+
+
+def fuse_queries(queries):
+    """
+    Combine a sequence of queries into a single callable.
+
+    The CSS, index, text, own text and attr queries have element-level forms (their
+    ``selects`` and ``reads`` attributes) which operate on lists of lxml elements, the
+    ``selects`` also take whether the elements are from an xml (xhtml) document.
+    When the value is an element or a `PyQuery`, the fused query runs those back to
+    back so no intermediate `PyQuery` objects are created, only a final selection is
+    wrapped. Other values, and chains with a field accessor, run the queries in turn.
+    """
+    if len(queries) == 1:
+        return queries[0]
+    chained_query = _chain_queries(queries)
+    selects = ()
+    read = None
+    for query in queries:
+        if read is None and hasattr(query, 'selects'):
+            selects += (query.selects,)
+        elif read is None and hasattr(query, 'reads'):
+            read = query.reads
+        else:
+            return chained_query
+    def fused_query(value, xhtml=False):
+        if isinstance(value, etree._Element):
+            elements = [value]
+        elif isinstance(value, PyQuery):
+            elements = value
+            xhtml = value._translator.xhtml
+        else:
+            return chained_query(value, xhtml)
+        for select in selects:
+            elements = select(elements, xhtml)
+        if read is not None:
+            return read(elements)
+        elif isinstance(value, PyQuery):
+            return PyQuery(elements, parent=value)
+        else:
+            return PyQuery(elements, css_translator=_translator(xhtml))
+    return fused_query
+
+
+class _Context(object):
+    """The state of a context while a `ContextNode` is being executed."""
+    __slots__ = ('rv', 'value', 'last_value', 'xhtml', 'shared_matches')
+
+    def __init__(self, rv, value, last_value, xhtml):
+        self.rv = rv
+        self.value = value
+        self.last_value = last_value
+        # whether the document is xml, from the root document's translator
+        self.xhtml = xhtml
+        # CSS query results shared by sibling queries, keyed by selector
+        self.shared_matches = None
+
+
+class _RunState(object):
+    """The current context and the stack of parent contexts it will return to."""
+    __slots__ = ('ctx', 'stack')
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.stack = []
+
+
+# opcodes of the instruction stream a `ContextNode` is lowered to, they index
+# into `_HANDLERS`
+OP_QUERY = 0
+OP_DO = 1
+OP_ENTER_CTX = 2
+OP_EXIT_CTX = 3
+OP_QUERY_SHARED = 4
+OP_REUSE_MATCHES = 5
+
+
+def _op_query_shared(arg, state):
+    selector, css_query, rest = arg
+    ctx = state.ctx
+    matches = css_query(ctx.value, ctx.xhtml)
+    if ctx.shared_matches is None:
+        ctx.shared_matches = {}
+    ctx.shared_matches[selector] = matches
+    ctx.last_value = rest(matches, ctx.xhtml) if rest is not None else matches
+
+
+def _op_reuse_matches(arg, state):
+    selector, rest = arg
+    ctx = state.ctx
+    matches = ctx.shared_matches[selector]
+    if rest is not None:
+        ctx.last_value = rest(matches, ctx.xhtml)
+    else:
+        # only share the elements, each query still gets its own PyQuery so saved
+        # results aren't the same object
+        ctx.last_value = PyQuery(list(matches), parent=matches._parent,
+                                 css_translator=matches._translator)
+
+
+def _op_do(node_do, state):
+    node_do(state.ctx)
+
+
+def _op_enter_ctx(_, state):
+    ctx = state.ctx
+    state.stack.append(ctx)
+    # value in a sub-context is derived from the last_value in the parent context
+    state.ctx = _Context(ctx.rv, ctx.last_value, ctx.last_value, ctx.xhtml)
+
+
+def _op_exit_ctx(_, state):
+    state.ctx = state.stack.pop()
+
+
+_HANDLERS = (
+    # unused, OP_QUERY is run inline by `ContextNode.do()`
+    None,
+    _op_do,
+    _op_enter_ctx,
+    _op_exit_ctx,
+    _op_query_shared,
+    _op_reuse_matches,
+)
+
+
+def _css_selector(node):
+    """The selector of the CSS query `node` starts with, if it is one."""
+    if type(node) is QueryNode:
+        return getattr(node.queries[0], 'selector', None)
+
+
+def _lower_nodes(nodes, code):
+    """
+    Append the instructions for `nodes` to `code`. Sub-contexts are inlined between
+    enter and exit instructions, directives are called via their `do()`.
+
+    Sibling queries start from the same context value, so when several of them begin
+    with the same CSS selector the selector is only run by the first one, the others
+    reuse its matches.
+    """
+    selectors = [_css_selector(node) for node in nodes]
+    shared = set(selector for selector in selectors
+                 if selector is not None and selectors.count(selector) > 1)
+    seen = set()
+    for node, selector in zip(nodes, selectors):
+        if type(node) is ContextNode:
+            code.append((OP_ENTER_CTX, None))
+            _lower_nodes(node.nodes, code)
+            code.append((OP_EXIT_CTX, None))
+        elif selector in shared:
+            rest = fuse_queries(node.queries[1:]) if len(node.queries) > 1 else None
+            if selector in seen:
+                code.append((OP_REUSE_MATCHES, (selector, rest)))
+            else:
+                seen.add(selector)
+                code.append((OP_QUERY_SHARED, (selector, node.queries[0], rest)))
+        elif type(node) is QueryNode:
+            code.append((OP_QUERY, node.query))
+        else:
+            code.append((OP_DO, node.do))
+    return code
 
 
 class ContextNode(object):
-    __slots__ = ('__depth', '__nodes', '__rv', '__value', 'last_value')
+    __slots__ = ('__depth', '__nodes', '__code')
 
     def __init__(self, depth, nodes):
         self.__depth = depth
         self.__nodes = nodes
-        self.__rv = None
-        self.__value = None
-        self.last_value = None
+        # lowered on first use, nested contexts are inlined into the code of the
+        # context that runs them, so most never need code of their own
+        self.__code = None
 
     @property
-    def rv(self):
-        return self.__rv
+    def nodes(self):
+        return self.__nodes
 
     @property
-    def value(self):
-        return self.__value
-
-    def do(self, context, rv=None, value=None, last_value=None):
-        self.__rv = rv if rv != None else context.rv
+    def code(self):
+        if self.__code is None:
+            code = _lower_nodes(self.__nodes, [])
+            # nothing runs after trailing exits, so drop them
+            while code and code[-1][0] == OP_EXIT_CTX:
+                code.pop()
+            self.__code = tuple(code)
+        return self.__code
+
+    def do(self, context, rv=None, value=None, last_value=None, xhtml=None):
+        rv = rv if rv is not None else context.rv
         # value in a sub-context is derived from the last_value in the parent context
-        self.__value = value if value != None else context.last_value
-        self.last_value = last_value if last_value != None else self.__value
-        for node in self.__nodes:
-            node.do(self)
+        value = value if value is not None else context.last_value
+        last_value = last_value if last_value is not None else value
+        if xhtml is None:
+            # directives pass the flag along, the root takes it from the document
+            if context is not None:
+                xhtml = context.xhtml
+            else:
+                xhtml = isinstance(value, PyQuery) and value._translator.xhtml
+        state = _RunState(_Context(rv, value, last_value, xhtml))
+        handlers = _HANDLERS
+        for op, arg in self.code:
+            if op == OP_QUERY:
+                # queries are the bulk of most templates, so they're run inline instead
+                # of paying for a handler call, last_value is based on context.value
+                ctx = state.ctx
+                ctx.last_value = arg(ctx.value, ctx.xhtml)
+            else:
+                handlers[op](arg, state)
 
 
-class QueryNode(namedtuple('QueryNode', 'queries')):
+class QueryNode(namedtuple('QueryNode', 'query queries')):
+    """
+    A query statement, ``query`` is the chain of ``queries`` fused into a single
+    callable at parse time. Query nodes are lowered to `OP_QUERY` instructions.
+    """
     __slots__ = ()
-    def do(self, context):
-        # start last_value based on context.value
-        val = context.value
-        # queries can be a sequence of queries
-        for query in self.queries:
-            val = query(val)
-        # update context.last_value
-        context.last_value = val
 
 
 class ChainedMapping(MutableMapping):
@@ -299,13 +561,16 @@ class ContextParser(object):
         else:
             raise UnexpectedTokenError(self._tok.type_, (TokenType.CSSSelector,
                                                          TokenType.AccessorSequence))
-        node = QueryNode(queries)
+        node = QueryNode(fuse_queries(queries), queries)
         self._nodes.append(node)
 
     def _parse_css_selector(self):
         selector = self._tok.content.strip()
         # expects a valid css selector
-        query = make_css_query(selector)
+        try:
+            query = make_css_query(selector)
+        except SelectorError:
+            raise TakeSyntaxError('Invalid CSS selector: %r' % selector, extra=self._tok)
         self.next_tok()
         if self._tok.type_ == TokenType.QueryStatementEnd:
             return (query,)
@@ -408,7 +673,11 @@ def parse(src):
         fobj = src
     scanner = Scanner(fobj)
     tok_generator = scanner.scan()
-    tok = next(tok_generator)
+    # tokens are scanned as the parser consumes them, so errors are raised as soon as
+    # the offending line is reached
+    tok = next(tok_generator, None)
+    if tok is None:
+        raise TakeSyntaxError('Empty template, no statements found.')
     if tok.type_ != TokenType.Context:
         raise UnexpectedTokenError(tok.type_, TokenType.Context, 'Leading context token not found')
     ctx_parser = ContextParser(tok.end, tok_generator)
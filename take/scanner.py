@@ -5,10 +5,10 @@ import re
 from .exceptions import ScanError
 
 
-_COMMENT_TEST_RX = re.compile(r'^\s*#.*$')
 _CTX_WS_RX = re.compile(r'\S')
 _INT_RX = re.compile(r'-?\d+')
 _WS_RX = re.compile(r'\s+')
+_INLINE_WS_RX = re.compile(r'[ \t]+')
 
 
 class Keywords(object):
@@ -23,6 +23,7 @@ class Keywords(object):
     params_start = ':'
     continuation = ','
     regexp_delimiter = '`'
+    comment_start = '#'
 
 
 class KeywordSets(object):
@@ -32,6 +33,19 @@ class KeywordSets(object):
     param_end = ' ' + Keywords.statement_end + Keywords.continuation
 
 
+_STATEMENT_END_RUN_RX = re.compile(re.escape(Keywords.statement_end) + '+')
+
+# patterns that match up to (not including) any of a set of characters, keyed by the set
+_UNTIL_RXS = {}
+
+
+def _until_rx(one_of):
+    rx = _UNTIL_RXS.get(one_of)
+    if rx is None:
+        rx = _UNTIL_RXS[one_of] = re.compile('[^%s]*' % re.escape(one_of))
+    return rx
+
+
 TokenType = Enum('TokenType', ' '.join((
     'Context',
     'QueryStatement',
@@ -94,8 +108,6 @@ class Scanner(object):
 
     def scan(self):
         while bool(self._next_line()):
-            if _COMMENT_TEST_RX.match(self.line):
-                continue
             scan_fn = self._scan_context
             while scan_fn:
                 scan_fn, tok = scan_fn()
@@ -159,29 +171,10 @@ class Scanner(object):
             self.pos += 1
         return ok
 
-    def _accept_run(self, valid=None, alpha=False, num=False, alphanum=False):
-        count = 0
-        tests = []
-        if valid:
-            tests.append(lambda: self._c in valid)
-        if alpha:
-            tests.append(lambda: self._c.isalpha())
-        if num:
-            tests.append(lambda: self._c.isdigit())
-        if alphanum:
-            tests.append(lambda: self._c.isalnum())
-        if not tests:
-            raise ScanError.make(self, 'Invalid _accept call, valid or preset not specified')
-        while not self._eol and any(t() for t in tests):
-            count += 1
-            self.pos += 1
-        return count
-
     def _accept_until(self, one_of):
-        count = 0
-        while not self._eol and self._c not in one_of:
-            count += 1
-            self.pos += 1
+        m = _until_rx(one_of).match(self.line, self.pos)
+        count = m.end() - self.pos
+        self.pos = m.end()
         return count
 
     def _consume(self, val):
@@ -196,10 +189,11 @@ class Scanner(object):
     def _consume_re(self, test_re):
         if self._eol:
             return False
-        m = test_re.match(self._to_eol_content)
+        # match in place rather than against a copy of the rest of the line
+        m = test_re.match(self.line, self.pos)
         if not m:
             return False
-        self.pos += m.end()
+        self.pos = m.end()
         return True
 
 
@@ -208,6 +202,9 @@ class Scanner(object):
         if not m:
             raise ScanError.make(self, 'Invalid state: error parsing context')
         self.pos = m.start()
+        # the indentation search also finds comment lines, which are discarded
+        if self._c == Keywords.comment_start:
+            return None, None
         tok = self._make_token(TokenType.Context)
         return self._scan_statement, tok
 
@@ -241,14 +238,14 @@ class Scanner(object):
                                         Keywords.statement_end))
 
     def _scan_directive_body(self):
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         if self._eol or self._c == Keywords.statement_end:
             return self._end_directive()
 
         if self._c == Keywords.continuation:
             self._accept(Keywords.continuation)
-            self._accept_run(' \t')
+            self._consume_re(_INLINE_WS_RX)
             self._ignore()
             if self._eol and not self._next_line():
                 raise ScanError.make(self, 'Unexpected EOF, directive parameter expected.')
@@ -288,7 +285,7 @@ class Scanner(object):
 
     def _scan_css_selector(self):
         self._accept(Keywords.css_start)
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         if self._accept_until(KeywordSets.css_query_end) < 1:
             raise ScanError.make(self, 'Invalid CSS Selector: %r' % self._to_eol_content)
@@ -309,7 +306,7 @@ class Scanner(object):
         return self._scan_accessor, tok
 
     def _scan_accessor(self):
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         if self._eol or self._c == Keywords.statement_end:
             return self._end_query()
@@ -364,7 +361,7 @@ class Scanner(object):
                                        'character ("`") expected.')
         tok = self._make_token(TokenType.TerseRegexp)
         self._accept(Keywords.regexp_delimiter)
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         if self._eol or self._c == Keywords.statement_end:
             return self._end_query, tok
@@ -381,7 +378,7 @@ class Scanner(object):
             # for the entire line, search for ` then check for ```
             while not self._eol:
                 total_len += self._accept_until(Keywords.regexp_delimiter)
-                if self._to_eol_content.startswith('```'):
+                if self.line.startswith('```', self.pos):
                     # found it, so set to exit outer loop then exit inner loop
                     done = True
                     break
@@ -409,7 +406,7 @@ class Scanner(object):
         self._accept('`')
         self._accept('`')
         self._accept('`')
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         if self._eol or self._c == Keywords.statement_end:
             return self._end_query, tok
@@ -418,8 +415,8 @@ class Scanner(object):
                                        self._to_eol_content)
 
     def _scan_inline_sub_ctx(self):
-        self._accept_run(Keywords.statement_end)
+        self._consume_re(_STATEMENT_END_RUN_RX)
         tok = self._make_token(TokenType.InlineSubContext)
-        self._accept_run(' \t')
+        self._consume_re(_INLINE_WS_RX)
         self._ignore()
         return self._scan_statement, tok
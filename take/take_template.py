@@ -1,6 +1,45 @@
+from functools import partial
+
 from pyquery import PyQuery
 
-from .parser import parse
+from ._compat import lru_cache, string_types, urljoin
+from .parser import compile_css_selector, parse
+
+
+_LINKS_XPATH = compile_css_selector('a')
+
+
+@lru_cache(maxsize=256)
+def _compile(src):
+    """Parse template source, memoized on the raw source string."""
+    return parse(src)
+
+
+@lru_cache(maxsize=32)
+def _parse_doc(html, base_url):
+    """Parse a document, memoized on the html string and base URL."""
+    doc = PyQuery(html)
+    if base_url:
+        _make_links_absolute(doc, base_url)
+    return doc
+
+
+def _is_cacheable_doc(args, kwargs):
+    """Only lone html strings are cached, PyQuery fetches http(s) URL strings."""
+    if len(args) != 1 or kwargs or not isinstance(args[0], string_types):
+        return False
+    return args[0].split('://', 1)[0] not in ('http', 'https')
+
+
+def _make_links_absolute(doc, base_url):
+    """
+    Equivalent to `PyQuery.make_links_absolute()`, but sets the ``href`` on the lxml
+    elements directly instead of wrapping every link in a `PyQuery` (twice).
+    """
+    join = partial(urljoin, base_url)
+    for tag in doc:
+        for link in _LINKS_XPATH(tag):
+            link.set('href', join(link.get('href')))
 
 
 class TakeTemplate(object):
@@ -10,15 +49,30 @@ class TakeTemplate(object):
         with open(path, 'rb') as f:
             return TakeTemplate(f.read().decode('utf-8'), **kwargs)
 
+    @staticmethod
+    def clear_cache():
+        """Discard all of the memoized, compiled templates and parsed documents."""
+        _compile.cache_clear()
+        _parse_doc.cache_clear()
+
     def __init__(self, src, **kwargs):
-        self.node = parse(src)
+        if isinstance(src, string_types):
+            self.node = _compile(src)
+        else:
+            # file-like and other iterable sources can't be used as a cache key
+            self.node = parse(src)
         self.base_url = kwargs.get('base_url', None)
 
     def take(self, *args, **kwargs):
         base_url = kwargs.pop('base_url', None) or self.base_url
-        _doc = PyQuery(*args, **kwargs)
-        if base_url:
-            _doc.make_links_absolute(base_url)
+        cache_doc = kwargs.pop('cache_doc', False)
+        if cache_doc and _is_cacheable_doc(args, kwargs):
+            # opt-in, the parsed document is shared by all the calls with the same html
+            _doc = _parse_doc(args[0], base_url)
+        else:
+            _doc = PyQuery(*args, **kwargs)
+            if base_url:
+                _make_links_absolute(_doc, base_url)
         rv = {}
         self.node.do(None, rv=rv, value=_doc, last_value=_doc)
         return rv
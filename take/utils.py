@@ -1,3 +1,6 @@
+from lxml import etree
+
+
 
 def split_name(name):
     if '.' in name:
@@ -30,3 +33,33 @@ def save_to_name_list(dest, name_parts, value):
                 dest[part] = {}
             dest = dest[part]
     dest[name_parts[-1]] = value
+
+
+def _add_text(tag, texts, no_tail=False):
+    if tag.text and not isinstance(tag, etree._Comment):
+        texts.append(tag.text)
+    for child in tag:
+        _add_text(child, texts)
+    if not no_tail and tag.tail:
+        texts.append(tag.tail)
+
+
+def elements_text(elements):
+    """The same text `PyQuery.text()` produces, read from the lxml elements."""
+    texts = []
+    for tag in elements:
+        _add_text(tag, texts, no_tail=True)
+    texts = [text.strip() for text in texts]
+    return ' '.join([text for text in texts if text])
+
+
+def elements_own_text(elements):
+    """Text nodes that are direct children of the elements, ie `PyQuery.contents()` text."""
+    texts = []
+    for tag in elements:
+        if tag.text:
+            texts.append(tag.text)
+        for child in tag:
+            if child.tail:
+                texts.append(child.tail)
+    return ''.join(texts)
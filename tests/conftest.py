@@ -0,0 +1,18 @@
+import os
+import pytest
+
+from pyquery import PyQuery
+
+# importing take compiles the scanner's and parser's module level patterns once
+# for the whole test run
+import take
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='session')
+def pq_doc():
+    """The html fixture, parsed once and shared by all the tests."""
+    with open(here + '/doc.html') as f:
+        return PyQuery(f.read())
@@ -1,8 +1,6 @@
 import os
 import pytest
 
-from pyquery import PyQuery
-
 from take import TakeTemplate
 from take.parser import InvalidDirectiveError, UnexpectedTokenError, TakeSyntaxError
 from take.scanner import ScanError
@@ -11,8 +9,6 @@ here = os.path.dirname(os.path.abspath(__file__))
 with open(here + '/doc.html') as f:
     html_fixture = f.read()
 
-pq_doc = PyQuery(html_fixture)
-
 
 @pytest.mark.directives
 @pytest.mark.namespace_directive
@@ -529,6 +525,17 @@ class TestShrinkDirective():
         assert data['auto_texted'] == 'with a child em'
 
 
+    def test_auto_call_text_save_each(self):
+        TMPL = """
+            $ #text-with-newlines em
+                save each: ems
+                    shrink ;                    save: text
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data['ems'] == [{'text': 'with a child em'}]
+
+
 @pytest.mark.directives
 @pytest.mark.custom_accessor_directive
 class TestCustomAccessorDirective():
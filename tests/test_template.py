@@ -5,14 +5,14 @@ from pyquery import PyQuery
 
 from take import TakeTemplate
 from take.parser import InvalidDirectiveError, UnexpectedTokenError, TakeSyntaxError
+from take.parser import OP_QUERY, OP_DO, OP_ENTER_CTX, OP_EXIT_CTX, \
+     OP_QUERY_SHARED, OP_REUSE_MATCHES
 from take.scanner import ScanError
 
 here = os.path.dirname(os.path.abspath(__file__))
 with open(here + '/doc.html') as f:
     html_fixture = f.read()
 
-pq_doc = PyQuery(html_fixture)
-
 
 @pytest.mark.basic
 class TestBaseFunctionality():
@@ -26,7 +26,19 @@ class TestBaseFunctionality():
         assert tt
 
 
-    def test_save(self):
+    def test_compiled_template_cache(self):
+        TMPL = """
+            $ h1 | text
+                save: value
+        """
+        tt = TakeTemplate(TMPL)
+        assert TakeTemplate(TMPL).node is tt.node
+        TakeTemplate.clear_cache()
+        assert TakeTemplate(TMPL).node is not tt.node
+        assert tt(html_fixture) == {'value': 'Text in h1'}
+
+
+    def test_save(self, pq_doc):
         TMPL = """
             save: value
         """
@@ -35,7 +47,7 @@ class TestBaseFunctionality():
         assert data['value'].html() == pq_doc.html()
 
 
-    def test_save_alias(self):
+    def test_save_alias(self, pq_doc):
         TMPL = """
             : value
         """
@@ -44,7 +56,7 @@ class TestBaseFunctionality():
         assert data['value'].html() == pq_doc.html()
 
 
-    def test_deep_save(self):
+    def test_deep_save(self, pq_doc):
         TMPL = """
             save: parent.value
         """
@@ -53,7 +65,7 @@ class TestBaseFunctionality():
         assert data['parent']['value'].html() == pq_doc.html()
 
 
-    def test_deep_save_alias(self):
+    def test_deep_save_alias(self, pq_doc):
         TMPL = """
             : parent.value
         """
@@ -62,7 +74,7 @@ class TestBaseFunctionality():
         assert data['parent']['value'].html() == pq_doc.html()
 
 
-    def test_save_css_query(self):
+    def test_save_css_query(self, pq_doc):
         TMPL = """
             $ h1
                 save: value
@@ -72,7 +84,7 @@ class TestBaseFunctionality():
         assert data['value'].html() == pq_doc('h1').html()
 
 
-    def test_save_css_query_hard_tabs(self):
+    def test_save_css_query_hard_tabs(self, pq_doc):
         TMPL = """
 \t\t\t$ h1
 \t\t\t\tsave: value
@@ -92,7 +104,7 @@ class TestBaseFunctionality():
         assert data == {'value': 'Text in h1'}
 
 
-    def test_save_css_index_query(self):
+    def test_save_css_index_query(self, pq_doc):
         TMPL = """
             $ a | 0
                 save: value
@@ -142,6 +154,61 @@ class TestBaseFunctionality():
         assert data['value'] == ''
 
 
+    def test_jquery_pseudo_class(self):
+        TMPL = """
+            $ a:last | text
+                save: value
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data['value'] == 'second content link'
+
+
+    def test_xml_parser_is_case_sensitive(self):
+        TMPL = """
+            $ Item | text
+                save: v
+            $ Item
+                save each: items
+                    | text
+                        save: t
+            $ Root
+                save each: roots
+                    $ Item | 0 text
+                        save: first
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt('<Root><Item>a</Item><Item>b</Item></Root>', parser='xml')
+        assert data == {'v': 'a b', 'items': [{'t': 'a'}, {'t': 'b'}],
+                        'roots': [{'first': 'a'}]}
+
+
+    def test_xml_save_each_items_are_elements(self):
+        TMPL = """
+            $ Root
+                save each: roots
+                    : self
+                    $ Item | 1 text
+                        save: second
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt('<Root><Item>a</Item><Item>b</Item></Root>', parser='xml')
+        row = data['roots'][0]
+        assert not isinstance(row['self'], PyQuery)
+        assert row['self'].tag == 'Root'
+        assert row['second'] == 'b'
+
+
+    def test_neg_index_past_start(self):
+        TMPL = """
+            $ a | -6 text
+                save: value
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data['value'] == ''
+
+
     def test_query_deep_save(self):
         TMPL = """
             $ h1 | text
@@ -342,6 +409,19 @@ class TestBaseFunctionality():
         assert data == expect
 
 
+    def test_save_each_index_accessor(self):
+        TMPL = """
+            $ nav a
+                save each: nav
+                    | 0 [href] ;        : url
+                    | -1 text ;         : text
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data == {'nav': [{'url': '/local/a', 'text': 'first nav item'},
+                                {'url': '/local/b', 'text': 'second nav item'}]}
+
+
     def test_base_url(self):
         TMPL = """
             $ a | 0 [href]
@@ -371,6 +451,108 @@ class TestBaseFunctionality():
                         'ext': 'http://ext.com/b'}
 
 
+    def test_base_url_all_links(self):
+        TMPL = """
+            $ a
+                save each: links
+                    | [href] ;      : url
+        """
+        tt = TakeTemplate(TMPL, base_url='http://www.example.com')
+        data = tt(html_fixture)
+        expect_doc = PyQuery(html_fixture).make_links_absolute('http://www.example.com')
+        expect = [{'url': PyQuery(a).attr('href')} for a in expect_doc('a')]
+        assert data['links'] == expect
+
+
+    def test_cache_doc(self):
+        TMPL = """
+            $ a | 0
+                save: link
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture, cache_doc=True)
+        assert data['link'].attr('href') == '/local/a'
+        assert tt(html_fixture, cache_doc=True)['link'][0] is data['link'][0]
+        assert tt(html_fixture)['link'][0] is not data['link'][0]
+        data = tt(html_fixture, cache_doc=True, base_url='http://www.example.com')
+        assert data['link'].attr('href') == 'http://www.example.com/local/a'
+
+
+    def test_cache_doc_skips_urls(self, monkeypatch):
+        TMPL = """
+            $ p | text
+                save: t
+        """
+        pages = ['<p>v1</p>', '<p>v2</p>']
+        monkeypatch.setattr('pyquery.pyquery.url_opener', lambda url, kwargs: pages.pop(0))
+        tt = TakeTemplate(TMPL)
+        assert tt('http://www.example.com', cache_doc=True) == {'t': 'v1'}
+        assert tt('http://www.example.com', cache_doc=True) == {'t': 'v2'}
+
+
+@pytest.mark.instructions
+class TestInstructionStream():
+
+    def test_sub_ctxs_are_inlined(self):
+        TMPL = """
+            $ section
+                $ ul | [id]
+                    save: value
+            $ h1 | text
+                save: title
+        """
+        tt = TakeTemplate(TMPL)
+        ops = [op for op, arg in tt.node.code]
+        assert ops == [OP_QUERY,
+                       OP_ENTER_CTX, OP_QUERY,
+                       OP_ENTER_CTX, OP_DO, OP_EXIT_CTX,
+                       OP_EXIT_CTX,
+                       OP_QUERY,
+                       OP_ENTER_CTX, OP_DO]
+        data = tt(html_fixture)
+        assert data == {'value': 'second-ul', 'title': 'Text in h1'}
+
+
+    def test_sibling_css_queries_are_shared(self, pq_doc):
+        TMPL = """
+            $ a | 0 [href]
+                save: local
+            $ a | -1 [href]
+                save: ext
+            $ a
+                save: all
+            $ h1
+                $ a | 0 ;           : not_a_sibling
+        """
+        tt = TakeTemplate(TMPL)
+        ops = [op for op, arg in tt.node.code]
+        assert ops == [OP_QUERY_SHARED, OP_ENTER_CTX, OP_DO, OP_EXIT_CTX,
+                       OP_REUSE_MATCHES, OP_ENTER_CTX, OP_DO, OP_EXIT_CTX,
+                       OP_REUSE_MATCHES, OP_ENTER_CTX, OP_DO, OP_EXIT_CTX,
+                       OP_QUERY,
+                       OP_ENTER_CTX, OP_QUERY,
+                       OP_ENTER_CTX, OP_DO]
+        data = tt(html_fixture)
+        assert data['local'] == '/local/a'
+        assert data['ext'] == 'http://ext.com/b'
+        assert data['all'].html() == pq_doc('a').html()
+        assert len(data['all']) == len(pq_doc('a'))
+        assert len(data['not_a_sibling']) == 0
+
+
+    def test_shared_matches_are_not_saved_twice(self):
+        TMPL = """
+            $ a
+                save: x
+            $ a
+                save: y
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data['x'] is not data['y']
+        assert list(data['x']) == list(data['y'])
+
+
 @pytest.mark.invalid_templates
 class TestInvalidTemplates():
 
@@ -410,6 +592,34 @@ class TestInvalidTemplates():
             tt = TakeTemplate(TMPL)
 
 
+    def test_invalid_css_selector_error(self):
+        TMPL = """
+            $ h1[id
+                save: fail
+        """
+        with pytest.raises(TakeSyntaxError):
+            tt = TakeTemplate(TMPL)
+
+
+    def test_scan_error_line(self):
+        TMPL = """
+            $ h1 | [href
+                save: fail
+            $ p | [href
+        """
+        with pytest.raises(ScanError) as exc_info:
+            tt = TakeTemplate(TMPL)
+        assert exc_info.value.line_num == 2
+
+
+    def test_empty_template_error(self):
+        TMPL = """
+            # only a comment
+        """
+        with pytest.raises(TakeSyntaxError):
+            tt = TakeTemplate(TMPL)
+
+
     def test_invalid_save_each_context(self):
         TMPL = """
             $ li
@@ -622,6 +832,19 @@ class TestRegexpQuery():
         assert data['value'] == 'h1'
 
 
+    def test_terse_regexp_absent_capture_group(self):
+        TMPL = """
+            $ h1 | 0 text
+                `in (\w+)`
+                    rx match
+                        | 3
+                            save: value
+        """
+        tt = TakeTemplate(TMPL)
+        data = tt(html_fixture)
+        assert data['value'] == None
+
+
     def test_terse_regexp_custom_accessor(self):
         TMPL = """
             accessor: in stuff